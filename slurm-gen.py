@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # Copyright (c) 2017, Felix Thaler
 # All rights reserved.
@@ -23,14 +23,23 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from __future__ import print_function
 import argparse
+import functools
+import math
+import operator
 import sys
 import re
+import shlex
 import hashlib
 import warnings
 
 
+_NUM_RE = re.compile(r'(\d+\.?\d*)-(\d+\.?\d*)(?::([+\-*/]?)(\d+\.?\d*))?')
+_RANGE_RE = re.compile(r'\[(([^=]+)=)?([^\]]*)\]')
+_STEP_OPS = {'+': operator.add, '-': operator.sub,
+             '*': operator.mul, '/': operator.truediv}
+
+
 def int_or_float(s):
     try:
         return int(s)
@@ -38,6 +47,25 @@ def int_or_float(s):
         return float(s)
 
 
+def num_range_length(first, last, op, step):
+    # number of elements of a numeric range, None if it is unbounded
+    eps = 1e-9
+    if op in ('+', '-'):
+        delta = step if op == '+' else -step
+        if delta == 0:
+            return None
+        n = (last - first) / delta
+    else:
+        factor = step if op == '*' else 1 / step
+        if first == 0 or factor == 1:
+            return None
+        if factor == 0 or last == 0:
+            # sequence either decays towards zero or leaves the range at once
+            return None if last == 0 and factor < 1 else 1
+        n = math.log(last / first) / math.log(factor)
+    return max(int(n + eps), 0) + 1
+
+
 def parse_id_range(s):
     if s.lower() == 'id':
         return ['${SLURM_ARRAY_TASK_ID}']
@@ -47,112 +75,138 @@ def parse_id_range(s):
 
 def parse_num_range(s):
     # range with optional step
-    p = re.compile(r'(\d+\.?\d*)-(\d+\.?\d*)(:([\\+-\\*/]?)(\d+\.?\d*))?')
-    m = p.match(s)
+    m = _NUM_RE.match(s)
     if m:
         first = int_or_float(m.group(1))
         last = int_or_float(m.group(2))
         if m.group(3) is not None:
-            op = '+' if m.group(4) is '' else m.group(4)
-            step = int_or_float(m.group(5))
+            op = '+' if m.group(3) == '' else m.group(3)
+            step = int_or_float(m.group(4))
         else:
             op = '+' if first <= last else '-'
             step = 1
-        if op not in {'+', '-', '*', '/'}:
-            raise ValueError('invalid operation, must be one of +, -, *, /')
-
-        def stepop(x):
-            n = 0
-            nmax = 10000
-            while min(first, last) <= x <= max(first, last) and n < nmax:
-                yield x
-                if op == '+':
-                    x += step
-                if op == '-':
-                    x -= step
-                if op == '*':
-                    x *= step
-                if op == '/':
-                    x /= step
-                n += 1
-            if n == nmax:
-                warnings.warn('cut range at {} elements'.format(n))
-        return list(stepop(first))
+        stepf = _STEP_OPS[op]
+
+        nmax = 10000
+        n = num_range_length(first, last, op, step)
+        if n is None or n > nmax:
+            n = nmax
+            warnings.warn('cut range at {} elements'.format(n))
+        if op in ('+', '-'):
+            values = [first] + [stepf(first, i * step) for i in range(1, n)]
+        else:
+            values = [first]
+            for _ in range(n - 1):
+                values.append(stepf(values[-1], step))
+        if values[-1] != last and math.isclose(values[-1], last):
+            # end point only reached up to rounding, emit the exact bound
+            values[-1] = last
+        return values
     else:
         raise ValueError('can not parse range')
 
 
 def parse_list_range(s):
     # comma-separated list
-    p = re.compile(r'[^,]+')
-    l = p.findall(s)
+    l = [item for item in s.split(',') if item]
     if not l:
         raise ValueError('can not parse list')
     return l
 
 
+@functools.lru_cache(maxsize=None)
 def parse_range(s):
-    try:
-        return parse_id_range(s)
-    except ValueError:
-        pass
-    try:
-        return parse_num_range(s)
-    except ValueError:
-        pass
-    try:
-        return parse_list_range(s)
-    except ValueError:
-        pass
-    raise ValueError('could not parse range {}'.format(s))
+    # results are cached, so they are returned as immutable tuples
+    if s.lower() == 'id':
+        values = parse_id_range(s)
+    elif _NUM_RE.match(s):
+        values = parse_num_range(s)
+    else:
+        try:
+            values = parse_list_range(s)
+        except ValueError:
+            raise ValueError('could not parse range {}'.format(s))
+    return tuple(values)
 
 
-def get_ranges(argstr):
+def get_ranges(args):
+    # ranges are substituted per argument and only the text around them is
+    # shell-quoted, so that the substituted variables are still expanded
     groups = dict()
     ranges = []
-
-    def subf(match):
-        range_id = match.group(2)
-        range_str = match.group(3)
-        if range_str:
-            idx = len(ranges)
-            if range_id:
-                if range_id in groups:
-                    raise ValueError('group with ID {} defined multiple times'
+    quoted = []
+
+    for pos, arg in enumerate(args):
+        parts = []
+        last = 0
+        for match in _RANGE_RE.finditer(arg):
+            range_id = match.group(2)
+            range_str = match.group(3)
+            if range_str:
+                idx = len(ranges)
+                if range_id:
+                    if range_id in groups:
+                        raise ValueError('group with ID {} defined multiple '
+                                         'times'.format(range_id))
+                    groups[range_id] = idx
+                ranges.append(range_str)
+            else:
+                if range_id not in groups:
+                    raise ValueError('group with ID {} not defined'
                                      .format(range_id))
-                groups[range_id] = idx
-            ranges.append(range_str)
-        else:
-            if range_id not in groups:
-                raise ValueError('group with ID {} not defined'
-                                 .format(range_id))
-            idx = groups[range_id]
-        return '${{v{}}}'.format(idx)
-
-    p = re.compile(r'\[(([^=]+)=)?([^\]]*)\]')
-    argstr = p.sub(subf, argstr)
-
-    return argstr, ranges
-
-
-def generate_sbatch(argstr, slurm_options, env_options,
+                idx = groups[range_id]
+            if match.start() > last:
+                parts.append(shlex.quote(arg[last:match.start()]))
+            parts.append('${{v{}}}'.format(idx))
+            last = match.end()
+        if ('[' in arg[last:] and
+                any(']' in a.split('[', 1)[0] for a in args[pos + 1:])):
+            # a later argument closes a bracket it did not open, most likely
+            # a range split across arguments, e.g. [foo, bar]
+            raise ValueError('unclosed range in argument {}'.format(arg))
+        if last < len(arg) or not arg:
+            parts.append(shlex.quote(arg[last:]))
+        quoted.append(''.join(parts))
+
+    return ' '.join(quoted), ranges
+
+
+def array_values(vs):
+    # linear integer progressions are emitted as bash brace expansion
+    if len(vs) > 2 and all(type(v) is int for v in vs):
+        step = vs[1] - vs[0]
+        if step != 0 and all(b - a == step for a, b in zip(vs, vs[1:])):
+            if abs(step) == 1:
+                return f'{{{vs[0]}..{vs[-1]}}}'
+            return f'{{{vs[0]}..{vs[-1]}..{abs(step)}}}'
+    return ' '.join(map(str, vs))
+
+
+def generate_sbatch(args, slurm_options, env_options,
                     slurm_output, outfile, parallel_limit,
-                    verbose):
-    inargstr = argstr
-    argstr, ranges = get_ranges(argstr)
+                    verbose, bundle=1):
+    argstr, ranges = get_ranges(args)
 
     range_values = [parse_range(r) for r in ranges]
 
-    total_jobs = 1
-    for r in range_values:
-        total_jobs *= len(r)
+    lens = [len(vs) for vs in range_values]
+
+    total_jobs = math.prod(lens)
+
+    sbatch_options = [f'--{opt}' for opt in slurm_options]
+    env_prefix = ' '.join(env_options)
 
     if verbose:
         print('total number of jobs to run:', file=sys.stderr)
         print('  {}'.format(total_jobs), file=sys.stderr)
+        if bundle > 1:
+            print('number of array jobs running {} jobs each:'.format(bundle),
+                  file=sys.stderr)
+            print('  {}'.format((total_jobs + bundle - 1) // bundle),
+                  file=sys.stderr)
         print('translated ranges:', file=sys.stderr)
         for r, vs in zip(ranges, range_values):
-            vstrs = [str(v) for v in vs]
+            vstrs = list(map(str, vs))
             if len(vs) > 10:
                 vstr = '  {:20} -> {}, ..., {}'.format(r,
                                                        ', '.join(vstrs[:5]),
@@ -162,65 +216,92 @@ def generate_sbatch(argstr, slurm_options, env_options,
             print(vstr, file=sys.stderr)
         if slurm_options:
             print('additional options passed to slurm:', file=sys.stderr)
-            print('  ' + ' '.join('--' + opt for opt in slurm_options),
-                  file=sys.stderr)
+            print('  ' + ' '.join(sbatch_options), file=sys.stderr)
         if env_options:
             print('additional environment variables set:', file=sys.stderr)
-            print('  ' + ' '.join(env_options))
+            print('  ' + env_prefix, file=sys.stderr)
 
     if slurm_output is None:
         # generate hashed output name from app arguments
-        h = hashlib.md5()
-        h.update(argstr)
-        slurm_output = h.hexdigest()
+        slurm_output = hashlib.blake2b(argstr.encode('utf-8'),
+                                       digest_size=8).hexdigest()
 
     # generate header code
 
-    print('#!/bin/bash -l', file=outfile)
-    for opt in slurm_options:
-        print('#SBATCH --{}'.format(opt), file=outfile)
+    if bundle <= 0:
+        raise ValueError('bundle size must be positive')
+    array_jobs = (total_jobs + bundle - 1) // bundle
+
+    # the script is assembled line by line and written at once
+    lines = ['#!/bin/bash -l']
+    lines.extend('#SBATCH ' + opt for opt in sbatch_options)
 
     if parallel_limit:
         if parallel_limit <= 0:
             raise ValueError('parallel job limit must be positive')
-        print('#SBATCH --array=0-{}%{}'.format(total_jobs - 1, parallel_limit),
-              file=outfile)
+        lines.append(f'#SBATCH --array=0-{array_jobs - 1}%{parallel_limit}')
     else:
-        print('#SBATCH --array=0-{}'.format(total_jobs - 1), file=outfile)
-    print('#SBATCH --output={}_%a.out'.format(slurm_output), file=outfile)
-    print(file=outfile)
+        lines.append(f'#SBATCH --array=0-{array_jobs - 1}')
+    if bundle > 1:
+        lines.append(f'#SBATCH --output={slurm_output}_bundle_%a.out')
+    else:
+        lines.append(f'#SBATCH --output={slurm_output}_%a.out')
+    lines.append('')
 
-    print('# sbatch script generated by slurm-gen using arguments:',
-          file=outfile)
-    print('# ' + inargstr, file=outfile)
-    print(file=outfile)
+    lines.append('# sbatch script generated by slurm-gen using arguments:')
+    lines.append('# ' + shlex.join(args).replace('\n', '\\n'))
+    lines.append('')
 
     # generate array code
 
+    id_values = parse_range('id')
     for i, vs in enumerate(range_values):
-        print('varray{}=({})'.format(i, ' '.join(str(v) for v in vs)),
-              file=outfile)
-    print(file=outfile)
+        if bundle > 1 and vs == id_values:
+            # taken from the bundled job index below
+            continue
+        lines.append(f'varray{i}=({array_values(vs)})')
+    lines.append('')
 
     # generate index computation code
 
-    print('r=${SLURM_ARRAY_TASK_ID}', file=outfile)
-    for i, vs in enumerate(range_values):
-        print('d=$(($r/{}))'.format(len(vs)), file=outfile)
-        print('i{}=$(($r - $d*{}))'.format(i, len(vs)), file=outfile)
-        print('r=$d', file=outfile)
-        print('v{0}=${{varray{0}[${{i{0}}}]}}'.format(i), file=outfile)
-        print(file=outfile)
+    if bundle > 1:
+        # run several jobs sequentially in each array task, writing the
+        # output of each job to its own file
+        indent = '    '
+        job_id = '${r}'
+        redirect = f' > "{slurm_output}_{job_id}.out" 2>&1'
+        lines.append(f'for ((_inner = 0; _inner < {bundle}; _inner++)); do')
+        lines.append(f'{indent}r=$((${{SLURM_ARRAY_TASK_ID}}*{bundle} + '
+                     f'$_inner))')
+        lines.append(f'{indent}[ $r -ge {total_jobs} ] && break')
+    else:
+        indent = ''
+        job_id = '${SLURM_ARRAY_TASK_ID}'
+        redirect = ''
+        lines.append('r=${SLURM_ARRAY_TASK_ID}')
+    stride = 1
+    for i, n in enumerate(lens):
+        if bundle > 1 and range_values[i] == id_values:
+            # the linear index is the bundled job index, not the array index
+            lines.append(f'{indent}v{i}=$r')
+        else:
+            lines.append(f'{indent}i{i}=$((($r / {stride}) % {n}))')
+            lines.append(f'{indent}v{i}=${{varray{i}[${{i{i}}}]}}')
+        stride *= n
+    lines.append('')
 
     # generate application invocation code
 
-    print(('if [ ! -s "{0}_${{SLURM_ARRAY_TASK_ID}}.out" ] || '
-           '[ -n "$(grep -l \'srun: error\' '
-           '"{0}_${{SLURM_ARRAY_TASK_ID}}.out")" ]').format(slurm_output),
-          file=outfile)
-    print('then', file=outfile)
-    print('    {} srun '.format(' '.join(env_options)) + argstr, file=outfile)
-    print('fi', file=outfile)
+    job_output = f'{slurm_output}_{job_id}.out'
+    lines.append(f'{indent}if [ ! -s "{job_output}" ] || '
+                 f'[ -n "$(grep -l \'srun: error\' "{job_output}")" ]')
+    lines.append(f'{indent}then')
+    lines.append(f'{indent}    {env_prefix} srun {argstr}{redirect}')
+    lines.append(f'{indent}fi')
+    if bundle > 1:
+        lines.append('done')
+
+    outfile.write('\n'.join(lines) + '\n')
 
 
 def main():
@@ -290,11 +371,22 @@ def main():
                         help=('maximum number of array jobs to '
                               'run in parallel.\nexample: %(prog)s -l '
                               '10 -- ./app -x [1-1000]'))
+    parser.add_argument('--bundle', '-b', type=int, metavar='K',
+                        default=1,
+                        help=('number of jobs to run sequentially in each '
+                              'array job,\nuseful if the number of jobs '
+                              'exceeds the maximum array size.\n'
+                              'example: %(prog)s -b 10 -- ./app -x [1-10000]'))
     parser.add_argument('--output', '-o', metavar='FILE',
                         help='output sbatch file')
     parser.add_argument('--slurm-output', '-u', metavar='BASENAME',
                         help=('basename for slurm output files, '
-                              'full name will be BASENAME_ID.out'))
+                              'full name will be BASENAME_ID.out.\n'
+                              'with --bundle, the output of each job is '
+                              'written to BASENAME_ID.out\nwith ID the '
+                              'job index, and the slurm log of each array '
+                              'job to\nBASENAME_bundle_ID.out with ID the '
+                              'array index'))
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='enable verbose output')
 
@@ -310,17 +402,15 @@ def main():
     # parse script arguments
     argsmap = parser.parse_args(sys.argv[1:argstart])
 
-    # concat application arguments
-    argstr = ' '.join(sys.argv[argstart + 1:])
-
     if argsmap.output:
-        outfile = open(argsmap.output, 'w')
+        outfile = open(argsmap.output, 'w', buffering=65536,
+                       encoding='utf-8', newline='\n')
     else:
         outfile = sys.stdout
 
-    generate_sbatch(argstr, argsmap.slurm, argsmap.environment,
-                    argsmap.slurm_output, outfile, argsmap.limit,
-                    argsmap.verbose)
+    generate_sbatch(sys.argv[argstart + 1:], argsmap.slurm,
+                    argsmap.environment, argsmap.slurm_output, outfile,
+                    argsmap.limit, argsmap.verbose, argsmap.bundle)
 
     if argsmap.output:
         outfile.close()